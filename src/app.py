@@ -2,12 +2,18 @@ import dash
 from dash import dcc, html, Input, Output
 import dash_bootstrap_components as dbc
 import plotly.express as px
+import plotly.graph_objects as go
+import numpy as np
 import pandas as pd
+from flask_caching import Cache
 from sodapy import Socrata
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import os
 import logging
+import threading
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -19,6 +25,10 @@ load_dotenv()
 DATA_URL = 'data.cdc.gov'
 DATA_SET = 'jr58-6ysp'
 APP_TOKEN = os.getenv('SOCRATA_APP_TOKEN')
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache')
+CACHE_PATH = os.path.join(CACHE_DIR, f'{DATA_SET}.parquet')
+CACHE_MAX_AGE_HOURS = 6
+FETCH_WORKERS = 8
 MODERN_BLUE_COLOR = "#007BFF"
 RED_COLOR = "#FF0000"
 DARK_BLUE_COLOR = "#00008B"
@@ -35,15 +45,72 @@ def fetch_data(data_url, data_set, app_token):
     logging.info(f"Fetching data from {data_url} with dataset {data_set}")
     client = Socrata(data_url, app_token)
     client.timeout = 90
-    results = client.get(data_set, limit=1500000)
+    total = int(client.get(data_set, select='count(*)')[0]['count'])
+    page_size = max(-(-total // FETCH_WORKERS), 1)
+    logging.info(f"Fetching {total} records in pages of {page_size}")
+
+    def fetch_page(offset):
+        # A stable order is required for offset paging to partition cleanly.
+        return client.get(data_set, limit=page_size, offset=offset, order=':id')
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        pages = executor.map(fetch_page, range(0, total, page_size))
+    results = [record for page in pages for record in page]
     logging.info(f"Data fetched: {len(results)} records")
     return pd.DataFrame.from_records(results)
 
+def fetch_variant_means(start_date, end_date, selected_variants):
+    logging.info(f"Fetching server-side variant means for {start_date} to {end_date}")
+    client = Socrata(DATA_URL, APP_TOKEN)
+    client.timeout = 30
+    where = f"week_ending between '{start_date}' and '{end_date}'"
+    if selected_variants:
+        quoted = ', '.join(f"'{variant}'" for variant in selected_variants)
+        where += f" and variant in ({quoted})"
+    return client.get(DATA_SET, select='variant, avg(share) as share',
+                      where=where, group='variant')
+
 def preprocess_data(df):
     logging.info("Preprocessing data")
     df['week_ending'] = pd.to_datetime(df['week_ending'])
     df['creation_date'] = pd.to_datetime(df['creation_date'])
-    df['share'] = df['share'].astype(float)
+    # Percent scale once here so callbacks never touch the column again;
+    # float32 is plenty for proportions and halves the memory bandwidth.
+    df['share'] = df['share'].astype(np.float32) * 100.0
+    df['variant'] = df['variant'].astype('category')
+    # The remaining Socrata payload columns are plain object-dtype strings;
+    # arrow-backed strings store them in one contiguous buffer instead of a
+    # PyObject per cell, cutting their footprint by roughly half.
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].astype('string[pyarrow]')
+    return df
+
+def _write_cache(df):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Write-then-rename so concurrently booting workers never read a partial file.
+    tmp_path = CACHE_PATH + '.tmp'
+    df.to_parquet(tmp_path, compression='zstd')
+    os.replace(tmp_path, CACHE_PATH)
+    logging.info(f"Cached data to {CACHE_PATH}")
+
+def _refresh_cache():
+    try:
+        df = fetch_data(DATA_URL, DATA_SET, APP_TOKEN)
+        _write_cache(preprocess_data(df))
+    except Exception:
+        logging.exception("Background cache refresh failed")
+
+def load_data():
+    if os.path.exists(CACHE_PATH):
+        age_hours = (datetime.now().timestamp() - os.path.getmtime(CACHE_PATH)) / 3600
+        if age_hours >= CACHE_MAX_AGE_HOURS:
+            logging.info(f"Cache is {age_hours:.1f}h old, refreshing in the background")
+            threading.Thread(target=_refresh_cache, daemon=True).start()
+        logging.info(f"Loading cached data from {CACHE_PATH} (age: {age_hours:.1f}h)")
+        return pd.read_parquet(CACHE_PATH)
+    df = fetch_data(DATA_URL, DATA_SET, APP_TOKEN)
+    df = preprocess_data(df)
+    _write_cache(df)
     return df
 
 def get_default_date_range():
@@ -54,19 +121,38 @@ def get_default_date_range():
 
 # Fetch and preprocess data
 logging.info("Starting data fetch and preprocess")
-df = fetch_data(DATA_URL, DATA_SET, APP_TOKEN)
-df = preprocess_data(df)
+df = load_data()
 latest_published_date = df['creation_date'].max().strftime('%B %d, 2023')
+VARIANT_OPTIONS = [{'label': 'All Variants', 'value': 'ALL'}] + \
+                  [{'label': variant, 'value': variant} for variant in df['variant'].cat.categories]
+# Collapse the raw frame to per-(variant, week) aggregates once: the callbacks
+# only ever need means (from total/count) and five-number summaries, so they
+# can scan this ~thousands-row table instead of 1.5M raw rows.
+weekly = df.groupby(['variant', 'week_ending'], observed=True)['share'].agg(
+    total='sum',
+    count='count',
+    min='min',
+    q1=lambda s: s.quantile(0.25),
+    median='median',
+    q3=lambda s: s.quantile(0.75),
+    max='max',
+).reset_index()
+del df
+weekly.sort_values('week_ending', inplace=True)
+weekly.reset_index(drop=True, inplace=True)
+_week_ns = weekly['week_ending'].values  # sorted datetime64[ns], shared by searchsorted below
+_variant_codes = weekly['variant'].cat.codes.values.astype(np.int16)
+_cat_index = {variant: i for i, variant in enumerate(weekly['variant'].cat.categories)}
 start_date_default, end_date_default = get_default_date_range()
 logging.info(f"Latest published date: {latest_published_date}")
 
 # Initialize Dash app
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.DARKLY])
 server = app.server
+cache = Cache(server, config={'CACHE_TYPE': 'SimpleCache'})
 
 # Define app layout
 app.layout = dbc.Container(fluid=True, children=[
-    dcc.Store(id='filtered-data'),
     dcc.Store(id='date-range-store', data={'start_date': str(start_date_default), 'end_date': str(end_date_default)}),
     dbc.Row(justify="center", children=[
         dbc.Col(md=8, children=[
@@ -83,8 +169,8 @@ app.layout = dbc.Container(fluid=True, children=[
                     id='date-picker-range',
                     start_date=start_date_default,
                     end_date=end_date_default,
-                    min_date_allowed=df['week_ending'].min().date(),
-                    max_date_allowed=df['week_ending'].max().date(),
+                    min_date_allowed=weekly['week_ending'].min().date(),
+                    max_date_allowed=weekly['week_ending'].max().date(),
                     className="mb-4"
                 ),
                 dbc.Row([
@@ -94,8 +180,7 @@ app.layout = dbc.Container(fluid=True, children=[
                 html.Label("Select Variant:", className="form-label"),
                 dcc.Dropdown(
                     id='variant-selector',
-                    options=[{'label': 'All Variants', 'value': 'ALL'}] +
-                            [{'label': variant, 'value': variant} for variant in df['variant'].unique()],
+                    options=VARIANT_OPTIONS,
                     value='ALL',
                     multi=True,
                     className="mb-4",
@@ -140,57 +225,121 @@ def reset_date_range(n_clicks):
         return str(start_date_default), str(end_date_default), 'bar'
     return dash.no_update, dash.no_update, dash.no_update
 
-@app.callback(
-    Output('filtered-data', 'data'),
-    [Input('date-picker-range', 'start_date'),
-     Input('date-picker-range', 'end_date'),
-     Input('variant-selector', 'value')])
+@functools.lru_cache(maxsize=64)
 def filter_data(start_date, end_date, selected_variants):
     logging.info(f"Filtering data for date range: {start_date} to {end_date} and variants: {selected_variants}")
-    start_date = pd.to_datetime(start_date).date()
-    end_date = pd.to_datetime(end_date).date()
+    start_ts = pd.Timestamp(start_date)
+    end_ts = pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)  # exclusive upper bound
+    lo = _week_ns.searchsorted(start_ts.to_datetime64())
+    hi = _week_ns.searchsorted(end_ts.to_datetime64())
+    filtered_df = weekly.iloc[lo:hi]
 
-    filtered_df = df.copy()
+    if 'ALL' not in selected_variants and len(selected_variants) > 0:
+        sel_codes = np.fromiter((_cat_index[variant] for variant in selected_variants
+                                 if variant in _cat_index), dtype=np.int16)
+        mask = np.in1d(_variant_codes[lo:hi], sel_codes)
+        filtered_df = filtered_df.loc[mask]
 
-    if 'ALL' not in selected_variants and selected_variants is not None and len(selected_variants) > 0:
-        filtered_df = filtered_df[filtered_df['variant'].isin(selected_variants)]
+    logging.info(f"Filtered data size: {filtered_df.shape}")
+    return filtered_df
 
-    filtered_df = filtered_df[
-        (filtered_df['week_ending'].dt.date >= start_date) &
-        (filtered_df['week_ending'].dt.date <= end_date)
-    ]
+@cache.memoize(timeout=300)
+def box_stats(start_date, end_date, selected_variants):
+    logging.info(f"Computing box stats for {start_date} to {end_date} and variants: {selected_variants}")
+    filtered_df = filter_data(start_date, end_date, selected_variants)
+    # Fences are exact; range-level quartiles are approximated by the
+    # count-weighted combination of the precomputed weekly quartiles.
+    weights = filtered_df['count']
+    agg = filtered_df.assign(
+        q1w=filtered_df['q1'] * weights,
+        medianw=filtered_df['median'] * weights,
+        q3w=filtered_df['q3'] * weights,
+    ).groupby('variant', observed=True, sort=False).agg(
+        lowerfence=('min', 'min'),
+        q1w=('q1w', 'sum'),
+        medianw=('medianw', 'sum'),
+        q3w=('q3w', 'sum'),
+        upperfence=('max', 'max'),
+        count=('count', 'sum'),
+    )
+    return pd.DataFrame({
+        'lowerfence': agg['lowerfence'],
+        'q1': agg['q1w'] / agg['count'],
+        'median': agg['medianw'] / agg['count'],
+        'q3': agg['q3w'] / agg['count'],
+        'upperfence': agg['upperfence'],
+    })
 
-    filtered_df['share'] = filtered_df['share'] * 100
-    logging.info(f"Filtered data size: {filtered_df.shape}")
-    return filtered_df.to_dict('records')
+@cache.memoize(timeout=300)
+def bar_agg(start_date, end_date, selected_variants):
+    logging.info(f"Aggregating bar data for {start_date} to {end_date} and variants: {selected_variants}")
+    variants_filter = () if 'ALL' in selected_variants else selected_variants
+    try:
+        results = fetch_variant_means(start_date, end_date, variants_filter)
+        variants = np.array([record['variant'] for record in results])
+        # The API aggregates the raw proportions, so rescale to percent here.
+        means = np.array([float(record['share']) for record in results]) * 100.0
+        return variants, means
+    except Exception:
+        logging.warning("Server-side aggregation failed, falling back to local bincount", exc_info=True)
+        filtered_df = filter_data(start_date, end_date, selected_variants)
+        categories = weekly['variant'].cat.categories
+        codes = filtered_df['variant'].cat.codes.values
+        sums = np.bincount(codes, weights=filtered_df['total'].values, minlength=len(categories))
+        counts = np.bincount(codes, weights=filtered_df['count'].values, minlength=len(categories))
+        present = counts > 0
+        return categories.to_numpy()[present], sums[present] / counts[present]
 
 @app.callback(
     Output('variant-distribution', 'figure'),
-    [Input('filtered-data', 'data'),
+    [Input('date-picker-range', 'start_date'),
+     Input('date-picker-range', 'end_date'),
+     Input('variant-selector', 'value'),
      Input('graph-type-selector', 'value')])
-def update_graph(filtered_data, graph_type):
+def update_graph(start_date, end_date, selected_variants, graph_type):
     logging.info(f"Updating graph with graph type: {graph_type}")
-    filtered_df = pd.DataFrame(filtered_data)
+    if selected_variants is None:
+        selected_variants = ()
+    elif isinstance(selected_variants, str):
+        selected_variants = (selected_variants,)
+    else:
+        selected_variants = tuple(sorted(selected_variants))
+    filtered_df = filter_data(start_date, end_date, selected_variants)
 
     if filtered_df.empty or 'variant' not in filtered_df.columns:
         logging.warning("No data available for the selected criteria.")
-        return px.scatter(title="No data available for the selected criteria.")
+        fig = go.Figure(go.Scattergl(x=[], y=[]))
+        fig.update_layout(title="No data available for the selected criteria.",
+                          uirevision='variant-distribution')
+        return fig
 
     if graph_type == 'box':
-        fig = px.box(filtered_df, x='variant', y='share',
-                     title="Distribution of SARS-CoV-2 Variant Proportions",
-                     labels={'share': 'Variant Proportion (%)', 'variant': 'Variant'},
-                     color='variant', notched=False)
+        stats = box_stats(start_date, end_date, selected_variants)
+        fig = go.Figure()
+        for variant, row in stats.iterrows():
+            fig.add_trace(go.Box(
+                name=str(variant),
+                lowerfence=[row['lowerfence']], q1=[row['q1']],
+                median=[row['median']], q3=[row['q3']],
+                upperfence=[row['upperfence']],
+            ))
+        fig.update_layout(title="Distribution of SARS-CoV-2 Variant Proportions",
+                          xaxis_title='Variant', yaxis_title='Variant Proportion (%)')
         fig.update_traces(hovertemplate='<b>%{x}</b><br>Proportion: %{y:.2f}%<extra></extra>')
     elif graph_type == 'bar':
-        filtered_df = filtered_df.groupby('variant', as_index=False).agg({'share': 'mean'})
-        fig = px.bar(filtered_df, x='variant', y='share',
-                     title="Proportions of SARS-CoV-2 Variants",
-                     labels={'share': 'Variant Proportion (%)', 'variant': 'Variant'},
-                     color='variant')
-        fig.update_layout(xaxis={'categoryorder': 'total descending'})
+        variants, means = bar_agg(start_date, end_date, selected_variants)
+        order = np.argsort(-means)
+        variants, means = variants[order], means[order]
+        palette = px.colors.qualitative.Plotly
+        fig = go.Figure(go.Bar(
+            x=variants, y=means,
+            marker_color=[palette[i % len(palette)] for i in range(len(variants))],
+        ))
+        fig.update_layout(title="Proportions of SARS-CoV-2 Variants",
+                          xaxis_title='Variant', yaxis_title='Variant Proportion (%)',
+                          xaxis={'categoryorder': 'array', 'categoryarray': variants})
 
-    fig.update_layout(transition_duration=500)
+    fig.update_layout(transition_duration=0, uirevision='variant-distribution')
     return fig
 
 # Run the app